@@ -1,12 +1,39 @@
 # app.py
 import streamlit as st
 import expert_checker_core as core
-import concurrent.futures
 import streamlit.components.v1 as components
 import time
 import json
+import os
 from io import StringIO
 
+LIVE_RENDER_INTERVAL = 0.5  # seconds between table updates while offers arrive
+LIVE_ROWS = 50
+REPORT_PAGE_SIZE = 100  # offers per page in the embedded report
+
+def render_live_offers(best_slot, table_slot, offers, update):
+    # offers is already filtered; the running best prices in update are not,
+    # so they are taken from offers instead.
+    best_new = best_display = None
+    for offer in offers:
+        best_new, best_display = core.update_best_prices(best_new, best_display, offer)
+    best = []
+    if best_new:
+        best.append(f"Beste neu: **{core.format_price(best_new['total_price'])}** — {best_new['store_name']}")
+    if best_display:
+        best.append(f"Ausstellung: **{core.format_price(best_display['total_price'])}** — {best_display['store_name']}")
+    best.append(f"{len(offers)} Angebote, {update['completed']}/{update['total']} Filialen abgefragt")
+    best_slot.markdown("  \n".join(best))
+    rows = [{
+        "Filiale": o["store_name"],
+        "Gesamtpreis": core.format_price(o["total_price"]),
+        "Online": o["online_stock"],
+        "Lokal": o["stock"],
+        "Ausstellung": "ja" if o["on_display"] else "",
+        "Entfernung (km)": o["distance"],
+    } for o in sorted(offers, key=lambda x: x["total_price"])[:LIVE_ROWS]]
+    table_slot.dataframe(rows, width="stretch", hide_index=True)
+
 st.set_page_config(page_title="expert checker (web)", layout="wide")
 st.title("expert checker — Web App")
 st.markdown("Schnellsuche für expert.de — URL, Artikelnummer oder Suchbegriff eingeben.")
@@ -18,9 +45,16 @@ with st.sidebar:
     st.markdown("**Filters**")
     only_new_default = st.checkbox("Nur neue Artikel (keine Ausstellungsstücke)", value=True)
     only_online_default = st.checkbox("Nur Online-Angebote anzeigen", value=False)
-    max_threads = st.slider("Max Threads (konservativ)", min_value=4, max_value=24, value=8, help="Weniger Threads reduziert Rate-Limit-Risiko.")
+    st.caption(f"Anfragelimit (automatisch): {core.rate_limiter.rate:.0f}/s")
+    st.caption(f"Laufende Filialabfragen (alle Sitzungen): {core.scheduler.in_flight()} / max. {core.scheduler.max_workers} parallel")
+    st.caption(f"Preis-Cache: {len(core.price_cache)} Einträge (frisch {core.PRICE_CACHE_TTL // 60} min)")
+    if st.button("Preis-Cache leeren"):
+        core.price_cache.clear()
+    if st.button("Negativ-Cache leeren", help="Filialen, die den Artikel zuletzt nicht führten, werden sonst meist übersprungen"):
+        core.negative_cache.clear()
+    st.download_button("Metriken (JSON)", data=json.dumps(core.metrics.snapshot(), indent=2), file_name="expert_metrics.json", mime="application/json")
     st.markdown("---")
-    st.markdown("Backup-Branchliste (optional)\n\nLade hier `expert_branches.json` hoch, wenn du eine lokale Kopie als Fallback nutzen willst.")
+    st.markdown("Filialliste (optional)\n\nLade hier eine `expert_branches.json` hoch, wenn die Filialliste der API nicht geladen werden kann. Sie wird nur genutzt, solange keine Liste von der API vorliegt.")
     uploaded = st.file_uploader("expert_branches.json", type=["json"])
     st.markdown("---")
     st.markdown("Session: Letzte Suchen (nur temporär, im Speicher)")
@@ -47,6 +81,17 @@ max_distance = None
 if not only_online_offers:
     max_distance = st.number_input("Max Distanz (km, 0 = unbegrenzt)", min_value=0, value=100, step=10)
 
+# Prometheus endpoint (/metrics, /metrics.json) if a port is configured
+if os.environ.get("METRICS_PORT"):
+    try:
+        core.start_metrics_server(int(os.environ["METRICS_PORT"]))
+    except (OSError, ValueError) as e:
+        st.sidebar.warning(f"Metrik-Endpunkt nicht gestartet: {e}")
+
+# Load/refresh the shared branch list and promotions without blocking this run
+core.branch_registry.warm()
+core.promotion_cache.warm()
+
 # Session history
 if "history" not in st.session_state:
     st.session_state.history = []
@@ -57,170 +102,154 @@ if btn_search:
     else:
         st.info("Suche gestartet...")
         try:
-            # If user uploaded branches file, write to temp path to pass to core
-            local_backup_path = None
-            if uploaded:
+            # An uploaded branch list becomes the registry's current list
+            # (once per upload, not on every search)
+            if uploaded and st.session_state.get("uploaded_branches") != uploaded.file_id:
                 try:
-                    content = uploaded.read().decode("utf-8")
-                    # Save to disk for core to read (in container)
-                    with open("expert_branches.json", "w", encoding="utf-8") as f:
-                        f.write(content)
-                    local_backup_path = "expert_branches.json"
-                    st.success("Backup-Branchliste hochgeladen und gespeichert.")
+                    branch_set = core.use_branch_list(json.loads(uploaded.getvalue().decode("utf-8")))
+                    st.session_state.uploaded_branches = uploaded.file_id
+                    if branch_set is None:
+                        st.info("Filialliste der API ist aktiv; die hochgeladene Liste wird nicht benötigt.")
+                    else:
+                        st.success(f"Filialliste hochgeladen: {len(branch_set)} Filialen (bis die API-Liste verfügbar ist).")
                 except Exception as e:
-                    st.warning("Upload failed; fallback to API only.")
-                    local_backup_path = None
+                    st.warning(f"Filialliste nicht übernommen ({e}); es bleibt die bisherige Liste.")
 
             start_time = time.time()
+            trace = core.SearchTrace()
 
-            # Determine articleId and URL
-            articleId = None
-            url = None
-
-            # If it's digits-only, try API resolve by articleId
-            if term.isdigit():
-                try:
-                    resp = core.get_branches(local_backup_path=local_backup_path)  # quick connectivity check
-                except Exception:
-                    pass
-                # try to map articleId -> webcode / url via pricepds
-                try:
-                    r = core.get_branch_product_data  # just check function exists
-                    # perform direct lookup using pricepds
-                    import requests
-                    rr = requests.get('https://production.brntgs.expert.de/api/pricepds',
-                                      params={'articleId': term, 'storeId': 'e_2879130'},
-                                      headers=core.headers, timeout=8)
-                    if rr.status_code == 200:
-                        d = rr.json()
-                        webcode = d.get("webcode")
-                        if webcode:
-                            tr = requests.get(f"https://production.brntgs.expert.de/api/search/article?webcode={webcode}", headers=core.headers, timeout=8)
-                            if tr.status_code == 200:
-                                td = tr.json()
-                                url = f"https://www.expert.de{td.get('link')}"
-                                articleId = int(term)
-                except Exception:
-                    pass
-
-            # If explicit expert URL provided
-            if url is None and "www.expert.de" in term and ".html" in term:
-                url = term.split(".html")[0] + ".html"
-                try:
-                    articleId = core.get_article_id(url)
-                except Exception:
-                    articleId = None
-
-            # If still nothing and not numeric: use suggest API and let user pick
-            if url is None and (not term.isdigit()):
+            # URL / articleId are resolved in core; free text goes through the
+            # suggest API and the user picks a hit
+            product_input = term
+            if not core.is_product_reference(term):
                 suggestions = core.get_article_id_from_search(term)
                 if not suggestions:
                     st.warning("Keine Treffer in Suggest-API.")
                     st.stop()
-                options = {f"{s[2]}": (s[0], s[1]) for s in suggestions if s[1]}
+                options = {f"{s[2]}": s for s in suggestions if s[1]}
                 choice = st.selectbox("Treffer auswählen:", list(options.keys()))
                 if choice:
-                    articleId, url = options[choice]
-
-            if not url:
+                    product_input = core.Product.from_suggestion(options[choice])
+
+            # Product, coordinates, branches and discount are fetched
+            # concurrently; the fan-out is queued as soon as they allow
+            query_radius = max_distance if (not only_online_offers) and max_distance else None
+            search = core.PreparedSearch(product_input, plz or None, query_radius, trace)
+            product = search.product.result()
+            if not product:
                 st.error("Konnte Produkt-URL nicht bestimmen.")
                 st.stop()
+            url = product.url
+            webcode = product.webcode
 
             # Coordinates
-            user_coords = None
-            if plz:
-                user_coords = core.get_coordinates(plz)
-                if user_coords is None:
-                    st.warning("PLZ-Koordinaten konnten nicht ermittelt; es werden nur Online-Angebote berücksichtigt.")
+            user_coords = search.coordinates.result()
+            if plz and user_coords is None:
+                st.warning("PLZ-Koordinaten konnten nicht ermittelt; es werden nur Online-Angebote berücksichtigt.")
+            if user_coords is None:
+                query_radius = None
 
-            # Branches
+            # Branches (online shop included; only those in range are queried)
             with st.spinner("Filialen abrufen..."):
-                branches = core.get_branches(local_backup_path=local_backup_path)
-            # Append online shop as before
-            online_shop = {
-                "store": {
-                    "id": "e_2879130",
-                    "expId": "2879130",
-                    "city": "Onlineshop <",
-                    "name": ">",
-                    "latitude": 0,
-                    "longitude": 0
-                }
-            }
-            branches.append(online_shop)
-
-            # Discount
-            discount = 0
-            if articleId:
-                try:
-                    discount = core.get_discount(articleId)
-                except Exception:
-                    discount = 0
+                branches, query_branches, plan = search.branches.result()
 
-            webcode = url.split("/")[-1].split("-")[0]
+            discount = search.discount.result()
 
-            # Query branches concurrently (conservative)
+            # Query branches concurrently; filters are applied locally so that
+            # changing them later needs no new requests.
             st.info("Hole Angebote (siehe Status)...")
-            results = []
-            with st.spinner("Angebote abfragen..."):
-                with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-                    futures = [executor.submit(core.process_branch_offer, b, url, user_coords, only_online_offers, only_new_items, webcode) for b in branches]
-                    completed = 0
-                    total = len(futures)
-                    progress_bar = st.progress(0)
-                    for f in concurrent.futures.as_completed(futures):
-                        completed += 1
-                        progress_bar.progress(int(completed/total*100))
-                        try:
-                            res = f.result()
-                            if res:
-                                # distance filter
-                                if (not only_online_offers) and user_coords and res.get("coordinates"):
-                                    dist = core.get_distance(user_coords, res["coordinates"])
-                                    if max_distance and dist>max_distance>0:
-                                        continue
-                                results.append(res)
-                        except Exception:
-                            continue
-
-            elapsed = time.time() - start_time
-            if not results:
-                st.warning("Keine Angebote gefunden.")
-            else:
-                # Sorting options
-                sort_by = st.selectbox("Sortieren nach", ["Gesamtpreis (aufsteigend)", "Gesamtpreis (absteigend)", "Filiale (alphabetisch)"])
-                if sort_by == "Gesamtpreis (aufsteigend)":
-                    results = sorted(results, key=lambda x: x['total_price'])
-                elif sort_by == "Gesamtpreis (absteigend)":
-                    results = sorted(results, key=lambda x: x['total_price'], reverse=True)
-                else:
-                    results = sorted(results, key=lambda x: x['store_name'])
-
-                # Build product title
-                product_title = webcode
-                try:
-                    import requests
-                    tresp = requests.get(f"https://production.brntgs.expert.de/api/search/article?webcode={webcode}", headers=core.headers, timeout=8)
-                    if tresp.status_code == 200:
-                        td = tresp.json()
-                        product_title = td.get("seoPageTitle","").split(" - bei expert kaufen")[0] if td.get("seoPageTitle") else td.get("article", product_title)
-                except Exception:
-                    pass
-
-                html = core.create_html_report_string(results, product_title, webcode, discount, branches)
-                st.success(f"{len(results)} Angebote gefunden in {int(elapsed)}s.")
-                # show embedded HTML
-                components.html(html, height=700, scrolling=True)
-                st.download_button("HTML herunterladen", data=html, file_name=f"expert_{webcode}.html", mime="text/html")
-
-                # store in session history
-                st.session_state.history.insert(0, {"term": term, "hits": len(results), "time": int(time.time())})
-                if len(st.session_state.history) > 20:
-                    st.session_state.history = st.session_state.history[:20]
-
-                st.markdown("**Session-History:**")
-                for h in st.session_state.history[:10]:
-                    st.write(f"- `{h['term']}` — {h['hits']} Treffer — {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(h['time']))}")
+            with st.spinner("Angebote abfragen..."), trace.stage("fanout"):
+                progress_bar = st.progress(0)
+                best_slot = st.empty()
+                table_slot = st.empty()
+                offers = []
+                last_render = 0
+                for update in core.iter_offers(query_branches, url, False, False, webcode, plan):
+                    if update["offer"]:
+                        offers.append(update["offer"])
+                    progress_bar.progress(int(update["completed"]/update["total"]*100))
+                    now = time.time()
+                    if update["offer"] and now - last_render >= LIVE_RENDER_INTERVAL:
+                        last_render = now
+                        render_live_offers(best_slot, table_slot, core.filter_offers(offers, only_online_offers, only_new_items), update)
+                best_slot.empty()
+                table_slot.empty()
+
+            st.session_state.result_set = {
+                "term": term,
+                "url": url,
+                "webcode": webcode,
+                "product_title": product.title,
+                "discount": discount,
+                "branches": branches,
+                "branch_version": search.branch_set.result().version,
+                "offers": offers,
+                "user_coords": user_coords,
+                "radius": query_radius,
+                "elapsed": time.time() - start_time,
+                "trace": trace.finish(),
+            }
+
+            # store in session history
+            st.session_state.history.insert(0, {"term": term, "hits": len(core.filter_offers(offers, only_online_offers, only_new_items)), "time": int(time.time())})
+            if len(st.session_state.history) > 20:
+                st.session_state.history = st.session_state.history[:20]
 
         except Exception as e:
             st.exception(e)
+
+# Render the last search from session state; sorting and filters only work on
+# the stored offers.
+result_set = st.session_state.get("result_set")
+if result_set:
+    active_distance = max_distance if (not only_online_offers) and result_set["user_coords"] else None
+    if result_set["radius"] and (not active_distance or active_distance > result_set["radius"]):
+        st.info(f"Abgefragt wurden nur Filialen im Umkreis von {result_set['radius']} km. Für einen größeren Umkreis bitte erneut suchen (bereits abgefragte Filialen kommen aus dem Cache).")
+    st.caption(f"Ergebnis für `{result_set['term']}`")
+    results = core.filter_offers(result_set["offers"], only_online_offers, only_new_items, active_distance)
+    if not results:
+        st.warning("Keine Angebote gefunden.")
+    else:
+        # Sorting options
+        sort_by = st.selectbox("Sortieren nach", ["Gesamtpreis (aufsteigend)", "Gesamtpreis (absteigend)", "Entfernung (aufsteigend)", "Filiale (alphabetisch)"])
+        if sort_by == "Gesamtpreis (aufsteigend)":
+            results = sorted(results, key=lambda x: x['total_price'])
+        elif sort_by == "Gesamtpreis (absteigend)":
+            results = sorted(results, key=lambda x: x['total_price'], reverse=True)
+        elif sort_by == "Entfernung (aufsteigend)":
+            results = sorted(results, key=lambda x: (x['distance'] is None, x['distance'] or 0, x['total_price']))
+        else:
+            results = sorted(results, key=lambda x: x['store_name'])
+
+        # Only one page of offers is rendered into the page; the branch table
+        # comes from the per-branch-list cache. The full report is built only
+        # when it is downloaded.
+        pages = (len(results) + REPORT_PAGE_SIZE - 1) // REPORT_PAGE_SIZE
+        page = 1
+        if pages > 1:
+            page = st.number_input(f"Seite (von {pages}, je {REPORT_PAGE_SIZE} Angebote)", min_value=1, max_value=pages, value=1, step=1)
+        best_prices = (None, None)
+        for offer in results:
+            best_prices = core.update_best_prices(best_prices[0], best_prices[1], offer)
+        webcode = result_set["webcode"]
+        report_args = (result_set["product_title"], webcode, result_set["discount"], result_set["branches"], result_set.get("branch_version"), best_prices)
+        report_start = time.perf_counter()
+        html = core.create_html_report_string(results[(page - 1) * REPORT_PAGE_SIZE:page * REPORT_PAGE_SIZE], *report_args)
+        report_time = time.perf_counter() - report_start
+        core.metrics.observe("expert_search_stage_seconds", report_time, stage="report")
+        st.success(f"{len(results)} Angebote gefunden in {int(result_set['elapsed'])}s.")
+        with st.expander("Zeitaufschlüsselung"):
+            search_trace = result_set["trace"]
+            rows = [{"Schritt": name, "Zeit (s)": round(t, 3)} for name, t in search_trace["stages"].items()]
+            rows.append({"Schritt": "report", "Zeit (s)": round(report_time, 3)})
+            rows.append({"Schritt": "gesamt (Suche)", "Zeit (s)": round(search_trace["total"], 3)})
+            st.dataframe(rows, hide_index=True)
+            st.caption(f"Wiederholungen: {search_trace['retries']}, Rate-Limits (429): {search_trace['throttled']} — prozessweit während der Suche")
+        # show embedded HTML
+        components.html(html, height=700, scrolling=True)
+        st.download_button("HTML herunterladen", data=lambda: core.create_html_report_string(results, *report_args), file_name=f"expert_{webcode}.html", mime="text/html")
+
+if st.session_state.history:
+    st.markdown("**Session-History:**")
+    for h in st.session_state.history[:10]:
+        st.write(f"- `{h['term']}` — {h['hits']} Treffer — {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(h['time']))}")
@@ -0,0 +1,157 @@
+# batch.py
+# Headless batch mode: checks many products across all branches and streams
+# the offers to JSONL or CSV as they arrive.
+#
+#   python batch.py products.txt -o offers.jsonl
+#   python batch.py products.txt -o offers.csv --plz 10115 --max-distance 50 --only-online
+#   python batch.py products.txt -o offers.jsonl --html reports/
+#
+# Input: one product per line, either an expert.de URL, "webcode:<n>",
+# "article:<n>" or a bare number (treated as articleId, like the web app).
+# Empty lines and lines starting with # are skipped.
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import sys
+import threading
+import time
+
+import expert_checker_core as core
+
+FIELDS = [
+    "input", "webcode", "articleId", "discount",
+    "store", "store_name", "url", "price", "shipping", "total_price",
+    "stock", "online_stock", "online_store", "on_display", "distance",
+]
+
+def read_inputs(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+class OfferWriter:
+    # Thread-safe row writer; every row is flushed so partial runs are usable.
+    def __init__(self, stream, fmt):
+        self.stream = stream
+        self.fmt = fmt
+        self.rows = 0
+        self._lock = threading.Lock()
+        self._csv = None
+        if fmt == "csv":
+            self._csv = csv.DictWriter(stream, fieldnames=FIELDS, extrasaction="ignore")
+            self._csv.writeheader()
+
+    def write(self, row):
+        with self._lock:
+            if self._csv:
+                self._csv.writerow(row)
+            else:
+                self.stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self.stream.flush()
+            self.rows += 1
+
+def run_product(line, branches, writer, args, branch_version=None):
+    # Returns the number of offers written, or None if the input could not
+    # be resolved to a product. With --html the product's offers are also
+    # kept for its report, which is streamed to disk.
+    product = core.resolve_product(line)
+    if product is None:
+        print(f"Übersprungen (nicht auflösbar): {line}", file=sys.stderr)
+        return None
+    webcode, articleId, url = product.webcode, product.articleId, product.url
+    discount = 0
+    if articleId:
+        try:
+            discount = core.get_discount(articleId)
+        except Exception:
+            discount = 0
+    count = 0
+    report_offers = [] if args.html else None
+    # Nothing reads the answers again, so they stay out of core.price_cache.
+    for update in core.iter_offers(branches, url, args.only_online, args.only_new, webcode, use_cache=False):
+        offer = update["offer"]
+        if not offer:
+            continue
+        row = {k: v for k, v in offer.items() if k != "coordinates"}
+        row.update({"input": line, "webcode": webcode, "articleId": articleId, "discount": discount})
+        writer.write(row)
+        count += 1
+        if report_offers is not None:
+            report_offers.append(offer)
+    if report_offers is not None:
+        report_offers.sort(key=lambda o: o['total_price'])
+        with open(os.path.join(args.html, f"expert_{webcode}.html"), 'w', encoding='utf-8') as f:
+            core.write_html_report(f, report_offers, product.title, webcode, discount, branches, branch_version)
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="expert checker im Batch-Modus")
+    parser.add_argument("inputs", help="Datei mit URLs, Webcodes oder Artikelnummern (eine pro Zeile)")
+    parser.add_argument("-o", "--output", default="-", help="Ausgabedatei (.jsonl oder .csv), Standard: stdout")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="Standard: aus der Dateiendung")
+    parser.add_argument("--plz", help="nur Filialen im Umkreis dieser PLZ (plus Onlineshop)")
+    parser.add_argument("--max-distance", type=int, default=0, help="Umkreis in km (mit --plz)")
+    parser.add_argument("--only-online", action="store_true", help="nur Angebote mit Online-Bestand")
+    parser.add_argument("--only-new", action="store_true", help="keine Ausstellungsstücke")
+    parser.add_argument("--products-parallel", type=int, default=4, help="gleichzeitig bearbeitete Produkte")
+    parser.add_argument("--html", metavar="DIR", help="zusätzlich einen HTML-Bericht pro Produkt in dieses Verzeichnis schreiben")
+    args = parser.parse_args(argv)
+    if args.max_distance and not args.plz:
+        parser.error("--max-distance braucht --plz")
+
+    if args.html:
+        os.makedirs(args.html, exist_ok=True)
+
+    fmt = args.format or ("csv" if args.output.endswith(".csv") else "jsonl")
+    branch_set = core.branch_registry.get()
+    branches = list(branch_set.branches) + [core.ONLINE_SHOP]
+    if args.plz:
+        user_coords = core.get_coordinates(args.plz)
+        if user_coords is None:
+            print(f"PLZ {args.plz} nicht gefunden.", file=sys.stderr)
+            return 2
+        branches = core.attach_distances(branch_set, user_coords) + [core.ONLINE_SHOP]
+        if args.max_distance:
+            branches = core.branches_in_range(branches, user_coords, args.max_distance, index=branch_set.index)
+
+    stream = sys.stdout if args.output == "-" else open(args.output, 'w', encoding='utf-8', newline='')
+    start = time.time()
+    products = failed = skipped = 0
+    try:
+        writer = OfferWriter(stream, fmt)
+        # Products run side by side; their (product x store) queries all share
+        # core.scheduler and core.rate_limiter. The semaphore keeps only a
+        # bounded number of products in flight so memory stays flat.
+        slots = threading.BoundedSemaphore(args.products_parallel)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.products_parallel) as executor:
+            def submit(line):
+                slots.acquire()
+                future = executor.submit(run_product, line, branches, writer, args, branch_set.version)
+                future.add_done_callback(lambda f: slots.release())
+                return future
+
+            for future in [submit(line) for line in read_inputs(args.inputs)]:
+                try:
+                    count = future.result()
+                except Exception as e:
+                    print(f"Fehler: {e}", file=sys.stderr)
+                    failed += 1
+                    continue
+                if count is None:
+                    skipped += 1
+                else:
+                    products += 1
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    print(f"{products} Produkte, {writer.rows} Angebote in {int(time.time() - start)}s"
+          f" ({skipped} nicht auflösbar, {failed} fehlgeschlagen).", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+# benchmark.py
+# Benchmarks the full search path against a local stand-in for the expert API.
+#
+#   python benchmark.py                        synthetic responses, 20 searches
+#   python benchmark.py --latency 80 --jitter 40 --rate-429 0.05 --searches 50 --concurrency 4
+#   python benchmark.py --record fixtures --webcode 1234567 --stores 50
+#   python benchmark.py --fixtures fixtures    replay recorded responses
+#
+# Each search takes the app's path: PreparedSearch (product, branch registry,
+# discount, prefetched fan-out) -> iter_offers with the prefetch plan ->
+# create_html_report_string for all offers (the app's download).
+
+import argparse
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import expert_checker_core as core
+
+DEFAULT_WEBCODE = "1000000"
+
+class StubState:
+    def __init__(self, fixtures, latency_ms, jitter_ms, rate_429, retry_after, seed):
+        self.fixtures = fixtures
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+
+    def delay(self, may_throttle=False):
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0
+            throttle = may_throttle and self.random.random() < self.rate_429
+            self.requests += 1
+            if throttle:
+                self.throttled += 1
+        time.sleep(max(0.0, self.latency_ms + jitter) / 1000.0)
+        return throttle
+
+def load_fixtures(path):
+    fixtures = {"pricepds": {}, "storeFinder": None, "activePromotions": None, "article": None}
+    if path:
+        for name in ("storeFinder", "activePromotions", "article", "pricepds"):
+            file = os.path.join(path, f"{name}.json")
+            if os.path.exists(file):
+                with open(file, 'r', encoding='utf-8') as f:
+                    fixtures[name] = json.load(f)
+    if fixtures["storeFinder"] is None:
+        with open(core.BRANCH_BACKUP_PATH, 'r', encoding='utf-8') as f:
+            fixtures["storeFinder"] = json.load(f)
+    if fixtures["activePromotions"] is None:
+        fixtures["activePromotions"] = synthetic_promotions()
+    return fixtures
+
+def synthetic_promotions(count=300):
+    rnd = random.Random(1)
+    return [{
+        "title": f"Aktion {i}",
+        "orderModification": [{
+            "affectedArticles": [str(rnd.randrange(10**6, 10**7)) for _ in range(rnd.randrange(1, 200))],
+            "discountRanges": [{"discount": rnd.choice([5, 10, 20, 50])}],
+        }],
+    } for i in range(count)]
+
+def synthetic_pricepds(webcode, store_id):
+    # Deterministic per (webcode, store): ~40% of stores do not list the item.
+    h = int(hashlib.sha1(f"{webcode}:{store_id}".encode()).hexdigest()[:8], 16)
+    if h % 10 < 4:
+        return {"articleId": webcode, "webcode": webcode, "price": {}}
+    online_stock = h % 3
+    return {
+        "articleId": webcode,
+        "webcode": webcode,
+        "price": {
+            "bruttoPrice": 400 + (h % 20000) / 100,
+            "onlineStock": online_stock,
+            "storeStock": (h >> 4) % 4,
+            "onlineStore": bool(online_stock),
+            "itemOnDisplay": {"onDisplay": (h >> 8) % 7 == 0},
+            "shipmentArray": [{"shipmentBruttoPrice": 4.99}],
+        },
+    }
+
+def make_handler(state):
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, payload, status=200, extra_headers=None, conditional=False):
+            body = json.dumps(payload).encode("utf-8")
+            if conditional and status == 200:
+                etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+                extra_headers = dict(extra_headers or {}, ETag=etag)
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (extra_headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            state.delay()
+            if self.path.startswith("/_api/storeFinder/searchStoresByGeoLocation"):
+                self.send_json(state.fixtures["storeFinder"])
+            else:
+                self.send_json({"error": "not found"}, 404)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            # 429s are only injected on pricepds, the endpoint the limiter paces.
+            throttle = state.delay(url.path == "/api/pricepds")
+            if throttle:
+                self.send_json({"error": "Too Many Requests"}, 429, {"Retry-After": str(state.retry_after)})
+            elif url.path == "/api/pricepds":
+                webcode = query.get("webcode") or query.get("articleId") or DEFAULT_WEBCODE
+                store_id = query.get("storeId", "")
+                recorded = state.fixtures["pricepds"].get(store_id)
+                self.send_json(recorded if recorded is not None else synthetic_pricepds(webcode, store_id), conditional=True)
+            elif url.path == "/api/activePromotions":
+                self.send_json(state.fixtures["activePromotions"])
+            elif url.path == "/api/search/article":
+                webcode = query.get("webcode", DEFAULT_WEBCODE)
+                self.send_json(state.fixtures["article"] or {"seoPageTitle": f"Artikel {webcode} - bei expert kaufen", "link": f"/shop/{webcode}-artikel.html"})
+            else:
+                self.send_json({"error": "not found"}, 404)
+
+    return StubHandler
+
+def start_stub_server(state, port=0):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_search(webcode):
+    start = time.perf_counter()
+    search = core.PreparedSearch(f"webcode:{webcode}")
+    product = search.product.result()
+    if product is None:
+        return time.perf_counter() - start, 0, 0
+    branches, query_branches, plan = search.branches.result()
+    discount = search.discount.result()
+    offers = [u["offer"] for u in core.iter_offers(query_branches, product.url, False, False, product.webcode, plan) if u["offer"]]
+    html = core.create_html_report_string(sorted(offers, key=lambda o: o['total_price']), product.title, product.webcode, discount, branches, search.branch_set.result().version)
+    return time.perf_counter() - start, len(offers), len(html)
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank: the smallest value with at least p% of values <= it.
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+def run_benchmark(args):
+    state = StubState(load_fixtures(args.fixtures), args.latency, args.jitter, args.rate_429, args.retry_after, args.seed)
+    server = start_stub_server(state)
+    core.API_BASE = f"http://127.0.0.1:{server.server_port}"
+    # Stub answers must never reach the caches real searches use: the price
+    # cache of an embedding process or the persistent negative cache.
+    core.price_cache = core.ResponseCache()
+    core.negative_cache = core.NegativeCache(path=None)
+    webcodes = [str(int(args.webcode) + i) for i in range(args.searches)]
+    if args.keep_cache:
+        webcodes = [args.webcode] * args.searches
+
+    tracemalloc.start()
+    latencies = []
+    offers = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for elapsed, count, _ in executor.map(run_search, webcodes):
+            latencies.append(elapsed)
+            offers += count
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    server.shutdown()
+
+    latencies.sort()
+    return {
+        "searches": len(latencies),
+        "concurrency": args.concurrency,
+        "wall_s": round(wall, 3),
+        "searches_per_s": round(len(latencies) / wall, 3) if wall else 0.0,
+        "upstream_requests": state.requests,
+        "upstream_requests_per_s": round(state.requests / wall, 1) if wall else 0.0,
+        "injected_429": state.throttled,
+        "offers": offers,
+        "latency_p50_s": round(percentile(latencies, 50), 3),
+        "latency_p95_s": round(percentile(latencies, 95), 3),
+        "latency_p99_s": round(percentile(latencies, 99), 3),
+        "peak_memory_mb": round(peak / 2**20, 1),
+        "final_rate_limit": round(core.rate_limiter.rate, 1),
+    }
+
+def record_fixtures(args):
+    # Captures a small, real response set to replay later. Keep --stores low.
+    os.makedirs(args.record, exist_ok=True)
+    raw_branches = core.get_branches()
+    promotions = core.get_promotions()
+    article = core.get_article_info(args.webcode)
+    pricepds = {}
+    for raw in raw_branches[:args.stores]:
+        store_id = raw["store"]["expId"]
+        pricepds[store_id] = core.fetch_branch_product_data(args.webcode, store_id)
+    for name, payload in (("storeFinder", raw_branches), ("activePromotions", promotions), ("article", article), ("pricepds", pricepds)):
+        with open(os.path.join(args.record, f"{name}.json"), 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False)
+    print(f"{len(pricepds)} pricepds-Antworten nach {args.record} geschrieben.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark der Suche gegen einen lokalen expert-API-Stub")
+    parser.add_argument("--searches", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1, help="gleichzeitige Suchen (Sitzungen)")
+    parser.add_argument("--latency", type=float, default=50.0, help="Antwortzeit in ms")
+    parser.add_argument("--jitter", type=float, default=20.0, help="+/- ms gleichverteilt")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Anteil der Antworten mit 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After (s) bei 429")
+    parser.add_argument("--fixtures", help="Verzeichnis mit aufgezeichneten Antworten")
+    parser.add_argument("--webcode", default=DEFAULT_WEBCODE)
+    parser.add_argument("--keep-cache", action="store_true", help="alle Suchen auf denselben Webcode (misst den Cache)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Ergebnis als JSON ausgeben")
+    parser.add_argument("--record", help="echte Antworten in dieses Verzeichnis aufzeichnen statt zu messen")
+    parser.add_argument("--stores", type=int, default=50, help="Anzahl Filialen beim Aufzeichnen")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        record_fixtures(args)
+        return 0
+    result = run_benchmark(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for key, value in result.items():
+            print(f"{key:>24}: {value}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
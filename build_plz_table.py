@@ -0,0 +1,85 @@
+# build_plz_table.py
+# Builds plz_de.csv (PLZ -> centroid) for the offline geocoder in expert_checker_core.
+#
+#   python build_plz_table.py DE.txt
+#       GeoNames postal code dump (https://download.geonames.org/export/zip/DE.zip).
+#       Gives the full table.
+#   python build_plz_table.py --from-georef georef-germany-postleitzahl.csv
+#       CSV export of https://public.opendatasoft.com/explore/dataset/georef-germany-postleitzahl/
+#       (PLZ areas from OpenStreetMap, ODbL), located at the area centroids.
+#       The bundled plz_de.csv is built from this one.
+#   python build_plz_table.py --from-branches expert_branches.json
+#       Only the PLZ of expert stores, located at the stores themselves.
+
+import argparse
+import csv
+import json
+import sys
+
+import expert_checker_core as core
+
+def read_geonames(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for row in csv.reader(f, delimiter='\t'):
+            # country, postal code, place, admin1..3 (name, code), lat, lng, accuracy
+            if len(row) < 11 or row[0] != "DE":
+                continue
+            yield row[1], float(row[9]), float(row[10])
+
+def read_georef(path):
+    # opendatasoft exports are ';'-separated; the point column holds "lat, lng".
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        reader = csv.reader(f, delimiter=';')
+        header = [h.lower() for h in next(reader)]
+        plz_col = next(i for i, h in enumerate(header) if "post code" in h or h in ("plz_code", "postleitzahl"))
+        point_col = next(i for i, h in enumerate(header) if h in ("geo point", "geo_point_2d"))
+        for row in reader:
+            if len(row) <= max(plz_col, point_col) or not row[point_col]:
+                continue
+            lat, lng = row[point_col].split(",")
+            yield row[plz_col], float(lat), float(lng)
+
+def read_branches(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for raw in json.load(f):
+            store = raw.get("store", {})
+            if store.get("zip") and (store.get("latitude") or store.get("longitude")):
+                yield store["zip"], float(store["latitude"]), float(store["longitude"])
+
+def build_table(points):
+    sums = {}
+    for plz, lat, lng in points:
+        plz = plz.strip()
+        if not plz.isdigit() or len(plz) != 5:
+            continue
+        s = sums.setdefault(plz, [0.0, 0.0, 0])
+        s[0] += lat
+        s[1] += lng
+        s[2] += 1
+    return sorted((plz, s[0] / s[2], s[1] / s[2]) for plz, s in sums.items())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PLZ-Tabelle für den Offline-Geocoder erzeugen")
+    parser.add_argument("source", help="GeoNames DE.txt, georef-CSV (mit --from-georef) oder expert_branches.json (mit --from-branches)")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--from-georef", action="store_true", help="Quelle ist der opendatasoft-Export georef-germany-postleitzahl")
+    source.add_argument("--from-branches", action="store_true", help="Quelle ist eine expert-Filialliste")
+    parser.add_argument("-o", "--output", default=core.PLZ_TABLE_PATH)
+    args = parser.parse_args(argv)
+
+    if args.from_georef:
+        points = read_georef(args.source)
+    elif args.from_branches:
+        points = read_branches(args.source)
+    else:
+        points = read_geonames(args.source)
+    table = build_table(points)
+    with open(args.output, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["plz", "latitude", "longitude"])
+        for plz, lat, lng in table:
+            writer.writerow([plz, f"{lat:.5f}", f"{lng:.5f}"])
+    print(f"{len(table)} PLZ nach {args.output} geschrieben.")
+
+if __name__ == "__main__":
+    sys.exit(main())
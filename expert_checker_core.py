@@ -3,27 +3,334 @@
 # Provides functions callable from a web UI.
 
 import requests
-import geopy.distance
+import requests.adapters
+import array
+import bisect
+import collections
+import contextlib
+import csv
+import numpy as np
+import concurrent.futures
+import email.utils
+import http.cookiejar
+import http.server
+import atexit
 import json
+import math
+import os
+import random
+import threading
 import time
 
 DEBUG = False
 
+API_BASE = "https://production.brntgs.expert.de"
+
+# Fan-out settings: one keep-alive pool shared by all workers, sized so that
+# every worker can hold its own connection without re-handshaking.
+# FANOUT_WORKERS caps concurrent upstream queries for the whole process.
+FANOUT_WORKERS = 32
+POOL_SIZE = 64
+
+# Shared pricepds rate limit (requests per second), adapted at runtime.
+RATE_LIMIT_START = 40.0
+RATE_LIMIT_MIN = 1.0
+RATE_LIMIT_MAX = 200.0
+
+# Branch list: refreshed in the background, local copy served until then.
+BRANCH_TTL = 6 * 3600
+BRANCH_BACKUP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "expert_branches.json")
+
+# Offline PLZ -> centroid table (see build_plz_table.py), loaded on first use.
+PLZ_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plz_de.csv")
+
+# Active promotions are indexed by articleId and refreshed on this schedule.
+PROMOTION_TTL = 15 * 60
+
+# pricepds responses per (webcode, storeId): fresh for PRICE_CACHE_TTL, then
+# served stale (and revalidated in the background) up to PRICE_CACHE_STALE.
+PRICE_CACHE_TTL = 5 * 60
+PRICE_CACHE_STALE = 30 * 60
+PRICE_CACHE_SIZE = 50000
+REPORT_CHUNK_ROWS = 500
+
+# Stores that returned no price for a webcode are skipped for
+# NEGATIVE_CACHE_TTL, except for a random share of re-checks. The file can be
+# moved with $NEGATIVE_CACHE_PATH; an empty value keeps it in memory only.
+NEGATIVE_CACHE_PATH = os.environ.get("NEGATIVE_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "negative_cache.json")) or None
+NEGATIVE_CACHE_TTL = 3 * 24 * 3600
+NEGATIVE_RECHECK_PROBABILITY = 0.1
+
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0',
 }
 
+def create_session(pool_size=POOL_SIZE):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Stay stateless like bare requests.get: never keep cookies set by expert
+    # (they could pin a store and leak into other branch queries).
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+session = create_session()
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metrics:
+    # Process-wide counters and latency histograms, keyed by name and labels.
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def total(self, name):
+        with self._lock:
+            return sum(v for (n, _), v in self._counters.items() if n == name)
+
+    def snapshot(self):
+        with self._lock:
+            counters = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+            histograms = {}
+            for (name, labels), hist in sorted(self._histograms.items()):
+                histograms.setdefault(name, []).append({
+                    "labels": dict(labels),
+                    "count": hist["count"],
+                    "sum": round(hist["sum"], 6),
+                    "buckets": {str(b): n for b, n in zip(self.buckets, hist["buckets"])},
+                })
+        return {"counters": counters, "histograms": histograms}
+
+    def prometheus_text(self):
+        def fmt(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in items) + "}"
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{fmt(labels)} {value}")
+            for (name, labels), hist in sorted(self._histograms.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                for bound, n in zip(self.buckets, hist["buckets"]):
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {n}")
+                lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{fmt(labels)} {hist['sum']}")
+                lines.append(f"{name}_count{fmt(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+
+class SearchTrace:
+    # Wall-clock time per stage of one search; also fed into the process metrics.
+    def __init__(self):
+        self.timings = {}
+        self._started = time.perf_counter()
+        self._retries = metrics.total("expert_store_retries_total")
+        self._throttled = metrics.total("expert_store_429_total")
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed
+            metrics.observe("expert_search_stage_seconds", elapsed, stage=name)
+
+    def finish(self):
+        total = time.perf_counter() - self._started
+        metrics.observe("expert_search_seconds", total)
+        # Process-wide deltas: with parallel searches these include their traffic.
+        return {
+            "total": total,
+            "stages": dict(self.timings),
+            "retries": metrics.total("expert_store_retries_total") - self._retries,
+            "throttled": metrics.total("expert_store_429_total") - self._throttled,
+        }
+
+def upstream_request(call, method, url, **kwargs):
+    start = time.perf_counter()
+    try:
+        r = session.request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        metrics.inc("expert_upstream_errors_total", call=call)
+        raise
+    finally:
+        metrics.observe("expert_upstream_seconds", time.perf_counter() - start, call=call)
+    metrics.inc("expert_upstream_responses_total", call=call, status=r.status_code)
+    return r
+
+_metrics_server = None
+
+def start_metrics_server(port, host="0.0.0.0"):
+    # Serves /metrics (Prometheus text) and /metrics.json; started once per process.
+    global _metrics_server
+    if _metrics_server is not None:
+        return _metrics_server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body, content_type = json.dumps(metrics.snapshot()).encode("utf-8"), "application/json"
+            elif self.path.startswith("/metrics"):
+                body, content_type = metrics.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    _metrics_server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    _metrics_server.daemon_threads = True
+    threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    return _metrics_server
+
+class RateLimiter:
+    # Process-wide AIMD pacing: every caller takes the next free time slot,
+    # successes raise the rate, 429s halve it for everyone.
+    def __init__(self, rate=RATE_LIMIT_START, min_rate=RATE_LIMIT_MIN, max_rate=RATE_LIMIT_MAX, increase=2.0, growth=0.25, decrease=0.5):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.growth = growth
+        self.decrease = decrease
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._blocked_until)
+            self._next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def on_success(self):
+        with self._lock:
+            # ~ +max(increase, growth * rate) req/s per second of successful
+            # traffic, so a cut is made up in seconds at any rate.
+            self.rate = min(self.max_rate, self.rate + max(self.increase, self.growth * self.rate) / self.rate)
+
+    def on_throttle(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            # One burst of 429s from in-flight requests counts as one signal,
+            # and 429s during a Retry-After block were sent before it: the
+            # block already answers them.
+            if now >= self._blocked_until and now - self._last_decrease >= 1.0:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._last_decrease = now
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            self._next_slot = max(self._next_slot, now + 1.0 / self.rate)
+
+rate_limiter = RateLimiter()
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def request_pricepds(params, request_headers, timeout):
+    # Every pricepds call goes through the shared limiter and reports back.
+    rate_limiter.acquire()
+    r = upstream_request("pricepds", "GET", f'{API_BASE}/api/pricepds', params=params, headers=request_headers, timeout=timeout)
+    if r.status_code == 429:
+        metrics.inc("expert_store_429_total", store=params.get("storeId", ""))
+        rate_limiter.on_throttle(parse_retry_after(r.headers.get("Retry-After")))
+    elif r.ok:
+        rate_limiter.on_success()
+    return r
+
 def get_article_id(url, timeout=10):
-    webcode = url.split("/")[-1].split("-")[0]
+    return get_article_id_for_webcode(url.split("/")[-1].split("-")[0], timeout)
+
+def get_article_id_for_webcode(webcode, timeout=10):
     params = {'webcode': webcode, 'storeId': 'e_2879130'}
-    r = requests.get('https://production.brntgs.expert.de/api/pricepds', params=params, headers=headers, timeout=timeout)
+    r = request_pricepds(params, headers, timeout)
     r.raise_for_status()
     data = r.json()
     return data.get("articleId")
 
+def get_webcode(articleId, timeout=8):
+    params = {'articleId': articleId, 'storeId': 'e_2879130'}
+    r = request_pricepds(params, headers, timeout)
+    r.raise_for_status()
+    return r.json().get("webcode")
+
+def get_article_info(webcode, timeout=8):
+    r = upstream_request("article", "GET", f"{API_BASE}/api/search/article", params={'webcode': webcode}, headers=headers, timeout=timeout)
+    if r.status_code != 200:
+        return None
+    return r.json()
+
 def get_article_id_from_search(search_term, timeout=10):
     params = {'q': search_term, 'storeId': 'e_2879130'}
-    r = requests.get('https://production.brntgs.expert.de/api/search/suggest', params=params, headers=headers, timeout=timeout)
+    r = upstream_request("suggest", "GET", f'{API_BASE}/api/search/suggest', params=params, headers=headers, timeout=timeout)
     r.raise_for_status()
     try:
         product_data = r.json().get("articleSuggest", [])
@@ -55,8 +362,9 @@ def get_branches(local_backup_path=None, timeout=10):
     cookies = {'fmarktcookie': 'e_2879130'}
 
     try:
-        r = requests.post(
-            'https://production.brntgs.expert.de/_api/storeFinder/searchStoresByGeoLocation',
+        r = upstream_request(
+            "storeFinder", "POST",
+            f'{API_BASE}/_api/storeFinder/searchStoresByGeoLocation',
             headers=headers_local,
             json=params,
             cookies=cookies,
@@ -74,25 +382,456 @@ def get_branches(local_backup_path=None, timeout=10):
             raise
     return branches
 
-def get_branch_product_data(webcode, storeid, max_retries=5, timeout=10):
-    headers_local = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0',
-        'Accept': 'application/json',
-        'Accept-Language': 'de,en-US;q=0.7,en;q=0.3',
+class Branch:
+    __slots__ = ("id", "exp_id", "name", "city", "latitude", "longitude", "distance")
+
+    def __init__(self, id, exp_id, name, city, latitude, longitude, distance=None):
+        self.id = id
+        self.exp_id = exp_id
+        self.name = name
+        self.city = city
+        self.latitude = latitude
+        self.longitude = longitude
+        self.distance = distance
+
+    @classmethod
+    def from_raw(cls, raw):
+        store = raw["store"]
+        return cls(store["id"], store["expId"], store["name"], store["city"], store.get("latitude") or 0, store.get("longitude") or 0)
+
+    @property
+    def coordinates(self):
+        return (self.latitude, self.longitude)
+
+    @property
+    def has_coordinates(self):
+        return bool(self.latitude or self.longitude)
+
+    @property
+    def display_name(self):
+        if self.city not in self.name:
+            return f"{self.name} {self.city}"
+        return self.name
+
+    def with_distance(self, distance):
+        return Branch(self.id, self.exp_id, self.name, self.city, self.latitude, self.longitude, distance)
+
+def as_branch(branch):
+    return branch if isinstance(branch, Branch) else Branch.from_raw(branch)
+
+ONLINE_SHOP = Branch("e_2879130", "2879130", ">", "Onlineshop <", 0, 0)
+
+class BranchSet:
+    # Immutable snapshot of the branch list with everything derived from it
+    # built once: coordinate array and spatial index.
+    def __init__(self, branches, version=0):
+        self.branches = tuple(branches)
+        self.version = version
+        self.coordinates = np.array([b.coordinates for b in self.branches], dtype=float).reshape(-1, 2)
+        self.index = BranchIndex(self.branches)
+
+    @classmethod
+    def from_raw(cls, raw_branches, version=0):
+        branches = []
+        for raw in raw_branches:
+            try:
+                branches.append(Branch.from_raw(raw))
+            except (KeyError, TypeError):
+                continue
+        return cls(branches, version)
+
+    def __len__(self):
+        return len(self.branches)
+
+class RefreshingCache:
+    # Holds one value that a background thread reloads once it is older than
+    # ttl. Readers never wait for a reload; only the very first load blocks,
+    # and only if initial() has nothing to serve. A first get() while a
+    # background load (from warm()) is running waits for that load.
+    def __init__(self, loader, ttl, initial=None, retry_interval=60):
+        self.loader = loader
+        self.ttl = ttl
+        self.initial = initial
+        self.retry_interval = retry_interval
+        self.version = 0  # last version handed to a loader
+        self._value = None
+        self._loaded_at = None
+        self._next_attempt = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._refreshed = threading.Condition(self._lock)
+        self._first_load = threading.Lock()
+
+    def get(self):
+        value = self._value
+        if value is None:
+            with self._first_load:
+                value = self._value
+                if value is None:
+                    value = self._serve_initial()
+                if value is None:
+                    value = self._wait_for_background()
+                if value is None:
+                    value = self.refresh()
+        self._maybe_refresh()
+        return value
+
+    def warm(self):
+        if self._value is None:
+            with self._first_load:
+                if self._value is None:
+                    self._serve_initial()
+        self._maybe_refresh()
+
+    def _reserve_version(self):
+        # Every load gets its own number, even when loads overlap; values
+        # are cached downstream by version (branch_table_html).
+        with self._lock:
+            self.version += 1
+            return self.version
+
+    def refresh(self):
+        value = self.loader(self._reserve_version())
+        with self._lock:
+            self._value = value
+            self._loaded_at = time.monotonic()
+        return value
+
+    def install_fallback(self, loader):
+        # Serves loader's value like initial() does, i.e. only until the first
+        # successful load; background loads keep being retried meanwhile.
+        # Returns None (and changes nothing) once a load has succeeded.
+        if self._loaded_at is not None:
+            return None
+        value = loader(self._reserve_version())
+        with self._lock:
+            if self._loaded_at is not None:
+                return None
+            self._value = value
+        return value
+
+    def _serve_initial(self):
+        if not self.initial:
+            return None
+        try:
+            value = self.initial(self._reserve_version())
+        except Exception as e:
+            if DEBUG:
+                print(f"Initialwert nicht verfügbar: {e}")
+            return None
+        with self._lock:
+            self._value = value
+        return value
+
+    def _wait_for_background(self):
+        with self._lock:
+            while self._refreshing:
+                self._refreshed.wait()
+            return self._value
+
+    def _maybe_refresh(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshing or now < self._next_attempt:
+                return
+            if self._loaded_at is not None and now - self._loaded_at < self.ttl:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            if DEBUG:
+                print(f"Hintergrund-Aktualisierung fehlgeschlagen: {e}")
+            with self._lock:
+                self._next_attempt = time.monotonic() + self.retry_interval
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._refreshed.notify_all()
+
+def _load_branch_backup(version):
+    with open(BRANCH_BACKUP_PATH, 'r', encoding='utf-8') as f:
+        return BranchSet.from_raw(json.load(f), version)
+
+def _checked_branch_set(raw_branches, version):
+    branch_set = BranchSet.from_raw(raw_branches, version)
+    if not branch_set:
+        # Never replace a usable list with an empty/garbled response.
+        raise ValueError("Filialliste ist leer")
+    return branch_set
+
+def _fetch_branch_set(version):
+    return _checked_branch_set(get_branches(), version)
+
+def use_branch_list(raw_branches):
+    # Uses a branch list from elsewhere (an uploaded expert_branches.json) while
+    # no list from the API has loaded; the API list always wins. Returns the
+    # installed BranchSet, or None if the API list is already in use.
+    return branch_registry.install_fallback(lambda version: _checked_branch_set(raw_branches, version))
+
+branch_registry = RefreshingCache(
+    loader=_fetch_branch_set,
+    ttl=BRANCH_TTL,
+    initial=_load_branch_backup,
+)
+
+class ResponseCache:
+    # Bounded LRU with a fresh and a stale window per entry.
+    def __init__(self, ttl=PRICE_CACHE_TTL, stale_ttl=PRICE_CACHE_STALE, max_size=PRICE_CACHE_SIZE):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._revalidating = set()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, None
+            stored_at, value = entry
+            age = time.monotonic() - stored_at
+            if age >= self.stale_ttl:
+                del self._entries[key]
+                return None, None
+            self._entries.move_to_end(key)
+            return value, ("fresh" if age < self.ttl else "stale")
+
+    def store(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def begin_revalidate(self, key):
+        with self._lock:
+            if key in self._revalidating:
+                return False
+            self._revalidating.add(key)
+            return True
+
+    def end_revalidate(self, key):
+        with self._lock:
+            self._revalidating.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+price_cache = ResponseCache()
+
+class Scheduler:
+    # One worker pool for every session. Jobs with the same key that are
+    # queued or running share one future instead of running twice.
+    def __init__(self, max_workers=FANOUT_WORKERS):
+        self.max_workers = max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="expert-fanout")
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            future = self._executor.submit(fn, *args, **kwargs)
+            self._in_flight[key] = future
+        future.add_done_callback(lambda f: self._forget(key, f))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+scheduler = Scheduler()
+
+class NegativeCache:
+    # webcode -> {storeId: time of last "not listed" answer}, persisted as JSON
+    # unless path is None.
+    def __init__(self, path=NEGATIVE_CACHE_PATH, ttl=NEGATIVE_CACHE_TTL, recheck_probability=NEGATIVE_RECHECK_PROBABILITY, save_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.recheck_probability = recheck_probability
+        self.save_interval = save_interval
+        self._misses = None
+        self._dirty = False
+        self._last_save = time.time()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # Caller holds the lock.
+        if self._misses is not None:
+            return
+        self._misses = {}
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        cutoff = time.time() - self.ttl
+        for webcode, stores in stored.items():
+            stores = {store: ts for store, ts in stores.items() if ts > cutoff}
+            if stores:
+                self._misses[webcode] = stores
+
+    def record(self, webcode, storeid, product_data):
+        listed = bool(((product_data or {}).get("price") or {}).get("bruttoPrice"))
+        webcode, storeid = str(webcode), str(storeid)
+        with self._lock:
+            self._load()
+            stores = self._misses.get(webcode)
+            if listed:
+                if stores and stores.pop(storeid, None) is not None:
+                    self._dirty = True
+            else:
+                self._misses.setdefault(webcode, {})[storeid] = time.time()
+                self._dirty = True
+
+    def is_miss(self, webcode, storeid):
+        with self._lock:
+            self._load()
+            ts = self._misses.get(str(webcode), {}).get(str(storeid))
+        return ts is not None and time.time() - ts < self.ttl
+
+    def should_skip(self, webcode, storeid):
+        # Known misses are still re-checked now and then, so a store that
+        # starts carrying the item is found again.
+        return self.is_miss(webcode, storeid) and random.random() >= self.recheck_probability
+
+    def save(self, force=False):
+        with self._lock:
+            if not self.path or self._misses is None or not self._dirty:
+                return
+            if not force and time.time() - self._last_save < self.save_interval:
+                return
+            # Expired entries are dropped from memory too, not just the file.
+            cutoff = time.time() - self.ttl
+            for webcode in list(self._misses):
+                stores = {s: ts for s, ts in self._misses[webcode].items() if ts > cutoff}
+                if stores:
+                    self._misses[webcode] = stores
+                else:
+                    del self._misses[webcode]
+            snapshot = {w: dict(stores) for w, stores in self._misses.items()}
+            self._dirty = False
+            self._last_save = time.time()
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            if DEBUG:
+                print(f"Negativ-Cache nicht gespeichert: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._misses = {}
+            self._dirty = True
+
+negative_cache = NegativeCache()
+atexit.register(negative_cache.save, True)
+
+def _revalidate_branch_product_data(key, max_retries, timeout):
+    # Shares its scheduler key with get_branch_product_data, so a search can
+    # join this job: it returns the fresh data, or the cached data if the
+    # request failed.
+    try:
+        data = fetch_branch_product_data(key[0], key[1], max_retries, timeout)
+        if data is not None:
+            price_cache.store(key, data)
+            negative_cache.record(key[0], key[1], data)
+            return data
+    except Exception as e:
+        if DEBUG:
+            print(f"Revalidierung für {key} fehlgeschlagen: {e}")
+    return price_cache.lookup(key)[0]
+
+def cached_branch_product_data(webcode, storeid, max_retries=5, timeout=10):
+    # Returns (hit, data) without a blocking request; stale hits trigger a
+    # background revalidation through the shared scheduler.
+    key = (str(webcode), str(storeid))
+    data, state = price_cache.lookup(key)
+    if state == "stale" and price_cache.begin_revalidate(key):
+        # The future may be a fetch already running for this key; either way
+        # the revalidation is over when it is done.
+        future = scheduler.submit(key, _revalidate_branch_product_data, key, max_retries, timeout)
+        future.add_done_callback(lambda f: price_cache.end_revalidate(key))
+    return state is not None, data
+
+def get_branch_product_data(webcode, storeid, max_retries=5, timeout=10, use_cache=True):
+    # use_cache=False neither reads nor fills price_cache (batch runs).
+    key = (str(webcode), str(storeid))
+    if use_cache:
+        hit, data = cached_branch_product_data(webcode, storeid, max_retries, timeout)
+        if hit:
+            return data
+    data = fetch_branch_product_data(webcode, storeid, max_retries, timeout)
+    if data is not None:
+        if use_cache:
+            price_cache.store(key, data)
+        negative_cache.record(webcode, storeid, data)
+    return data
+
+branch_product_headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Accept': 'application/json',
+    'Accept-Language': 'de,en-US;q=0.7,en;q=0.3',
+}
+
+def fetch_branch_product_data(webcode, storeid, max_retries=5, timeout=10):
+    r = _request_branch_product(webcode, storeid, branch_product_headers, max_retries, timeout)
+    return r.json() if r is not None else None
+
+def poll_branch_product_data(webcode, storeid, etag=None, last_modified=None, max_retries=5, timeout=10):
+    # Conditional pricepds request. Returns None if every attempt was rate
+    # limited, otherwise a dict with not_modified, data and the validators to
+    # send next time (kept from the previous poll on 304).
+    request_headers = dict(branch_product_headers)
+    if etag:
+        request_headers['If-None-Match'] = etag
+    if last_modified:
+        request_headers['If-Modified-Since'] = last_modified
+    r = _request_branch_product(webcode, storeid, request_headers, max_retries, timeout)
+    if r is None:
+        return None
+    not_modified = r.status_code == 304
+    return {
+        "not_modified": not_modified,
+        "data": None if not_modified else r.json(),
+        "etag": r.headers.get("ETag") or etag,
+        "last_modified": r.headers.get("Last-Modified") or last_modified,
     }
+
+def _request_branch_product(webcode, storeid, request_headers, max_retries, timeout):
     params = {'webcode': webcode, 'storeId': storeid}
     retry_delay = 2
     for attempt in range(max_retries):
+        if attempt:
+            metrics.inc("expert_store_retries_total", store=storeid)
         try:
-            r = requests.get('https://production.brntgs.expert.de/api/pricepds', headers=headers_local, params=params, timeout=timeout)
+            r = request_pricepds(params, request_headers, timeout)
             if r.status_code == 429:
                 if DEBUG:
-                    print(f"Rate limit für {storeid}. Warte {retry_delay}s...")
-                time.sleep(retry_delay)
-                retry_delay *= 2
+                    print(f"Rate limit für {storeid}. Neues Limit {rate_limiter.rate:.1f}/s")
                 continue
             r.raise_for_status()
-            return r.json()
+            return r
         except requests.exceptions.RequestException as e:
             if attempt == max_retries - 1:
                 if DEBUG:
@@ -102,44 +841,192 @@ def get_branch_product_data(webcode, storeid, max_retries=5, timeout=10):
             retry_delay *= 2
             continue
 
-def get_coordinates(plz, timeout=8):
+class PlzIndex:
+    # Sorted PLZ with parallel coordinate arrays; lookups are one bisect.
+    # Read-only once built, so it is shared without a lock.
+    __slots__ = ("codes", "latitudes", "longitudes")
+
+    def __init__(self, rows=()):
+        rows = sorted(rows)
+        self.codes = array.array('l', (r[0] for r in rows))
+        self.latitudes = array.array('d', (r[1] for r in rows))
+        self.longitudes = array.array('d', (r[2] for r in rows))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            return cls((int(plz), float(lat), float(lng)) for plz, lat, lng in reader)
+
+    def lookup(self, plz):
+        i = bisect.bisect_left(self.codes, plz)
+        if i < len(self.codes) and self.codes[i] == plz:
+            return (self.latitudes[i], self.longitudes[i])
+        return None
+
+    def __len__(self):
+        return len(self.codes)
+
+_plz_index = None
+_plz_index_lock = threading.Lock()
+
+def get_plz_index():
+    global _plz_index
+    if _plz_index is None:
+        with _plz_index_lock:
+            if _plz_index is None:
+                try:
+                    _plz_index = PlzIndex.load(PLZ_TABLE_PATH)
+                except (OSError, ValueError) as e:
+                    if DEBUG:
+                        print(f"PLZ-Tabelle nicht lesbar: {e}")
+                    _plz_index = PlzIndex()
+    return _plz_index
+
+def get_coordinates(plz):
+    # Bundled table only: no network on the search path. Unknown codes
+    # return None.
     try:
         plz = plz.strip()
         if not plz.isdigit() or len(plz) != 5:
             if DEBUG:
                 print(f"Ungültige PLZ: {plz}")
             return None
-        r = requests.get(f"https://api.zippopotam.us/de/{plz}", timeout=timeout)
-        if r.status_code != 200:
-            return None
-        data = r.json()
-        place = data["places"][0]
-        return (float(place["latitude"]), float(place["longitude"]))
+        coords = get_plz_index().lookup(int(plz))
     except Exception:
         return None
+    if coords is None and DEBUG:
+        print(f"PLZ {plz} nicht gefunden.")
+    return coords
 
-def get_discount(articleId, timeout=10):
-    total_discount = 0
-    r = requests.get("https://production.brntgs.expert.de/api/activePromotions", headers=headers, timeout=timeout)
+def get_promotions(timeout=10):
+    r = upstream_request("activePromotions", "GET", f"{API_BASE}/api/activePromotions", headers=headers, timeout=timeout)
     r.raise_for_status()
-    promotions = r.json()
-    seen_titles = set()
+    return r.json()
+
+def build_discount_index(promotions):
+    # articleId -> summed discount; a promotion title counts once per article.
+    index = {}
+    seen_titles = {}
     for promotion in promotions:
         try:
-            affectedArticles = promotion["orderModification"][0]["affectedArticles"]
-            if articleId in affectedArticles:
-                title = promotion.get("title", "")
-                if title in seen_titles:
-                    continue
-                seen_titles.add(title)
-                discount = promotion["orderModification"][0]["discountRanges"][0]["discount"]
-                total_discount += discount
-        except KeyError:
-            pass
-    return total_discount
+            modification = promotion["orderModification"][0]
+            affectedArticles = modification["affectedArticles"]
+            discount = modification["discountRanges"][0]["discount"]
+        except (KeyError, IndexError, TypeError):
+            continue
+        title = promotion.get("title", "")
+        for articleId in affectedArticles:
+            articleId = str(articleId)
+            titles = seen_titles.setdefault(articleId, set())
+            if title in titles:
+                continue
+            titles.add(title)
+            index[articleId] = index.get(articleId, 0) + discount
+    return index
+
+promotion_cache = RefreshingCache(
+    loader=lambda version: build_discount_index(get_promotions()),
+    ttl=PROMOTION_TTL,
+)
 
-def get_distance(coords1, coords2):
-    return int(round(geopy.distance.geodesic(coords1, coords2).km, 0))
+def get_discount(articleId):
+    return promotion_cache.get().get(str(articleId), 0)
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+def haversine_km(coords1, coords2):
+    lat1, lng1 = map(math.radians, coords1)
+    lat2, lng2 = map(math.radians, coords2)
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def distances_km(origin, coords):
+    # Haversine from one origin to an (n, 2) array of lat/lng in a single call.
+    coords = np.radians(np.asarray(coords, dtype=float).reshape(-1, 2))
+    lat1, lng1 = np.radians(origin[0]), np.radians(origin[1])
+    lat2, lng2 = coords[:, 0], coords[:, 1]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+def attach_distances(branches, user_coordinates):
+    # Returns per-search copies; registry branches are shared between sessions.
+    if isinstance(branches, BranchSet):
+        coords, branches = branches.coordinates, branches.branches
+    else:
+        branches = [as_branch(b) for b in branches]
+        coords = [b.coordinates for b in branches]
+    dists = distances_km(user_coordinates, coords)
+    # Branches without coordinates (online shop) get no distance.
+    return [b.with_distance(int(round(float(d))) if b.has_coordinates else None) for b, d in zip(branches, dists)]
+
+class BranchIndex:
+    # Uniform lat/lng grid over the branch list. Branches without coordinates
+    # (the online shop is listed at 0/0) are not indexed.
+    def __init__(self, branches, cell_deg=0.5):
+        self.cell_deg = cell_deg
+        self.cells = {}
+        for branch in branches:
+            if not branch.has_coordinates:
+                continue
+            self.cells.setdefault(self._cell(branch.latitude, branch.longitude), []).append((branch.coordinates, branch))
+        self._max_ring = 0
+        if self.cells:
+            rows = [c[0] for c in self.cells]
+            cols = [c[1] for c in self.cells]
+            self._max_ring = max(max(rows) - min(rows), max(cols) - min(cols)) + 1
+
+    def _cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg)))
+
+    def _ring(self, center, r):
+        ci, cj = center
+        if r == 0:
+            yield center
+            return
+        for di in range(-r, r + 1):
+            for dj in (-r, r) if abs(di) != r else range(-r, r + 1):
+                yield (ci + di, cj + dj)
+
+    def within(self, coords, radius_km):
+        lat, lng = coords
+        dlat = radius_km / KM_PER_DEGREE
+        dlng = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(min(89.0, abs(lat) + dlat))), 0.01))
+        i0, j0 = self._cell(lat - dlat, lng - dlng)
+        i1, j1 = self._cell(lat + dlat, lng + dlng)
+        hits = []
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                for branch_coords, branch in self.cells.get((i, j), ()):
+                    dist = haversine_km(coords, branch_coords)
+                    if dist <= radius_km:
+                        hits.append((dist, branch))
+        hits.sort(key=lambda h: h[0])
+        return hits
+
+    def nearest(self, coords, k):
+        center = self._cell(*coords)
+        hits = []
+        for r in range(self._max_ring + 1):
+            for cell in self._ring(center, r):
+                for branch_coords, branch in self.cells.get(cell, ()):
+                    hits.append((haversine_km(coords, branch_coords), branch))
+            hits.sort(key=lambda h: h[0])
+            # Anything in ring r+1 is at least r full cells away.
+            edge_lat = min(89.0, abs(coords[0]) + (r + 1) * self.cell_deg)
+            bound = r * self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(edge_lat))
+            if len(hits) >= k and hits[k - 1][0] <= bound:
+                break
+        return hits[:k]
+
+def branches_in_range(branches, user_coordinates, max_distance, index=None):
+    if index is None:
+        index = BranchIndex(branches)
+    in_range = {branch.id for _, branch in index.within(user_coordinates, max_distance)}
+    # Keep everything the index cannot place, i.e. the online shop.
+    return [b for b in branches if b.id in in_range or not b.has_coordinates]
 
 def format_price(number, is_shipping=False, has_online_stock=False):
     if is_shipping and not has_online_stock:
@@ -148,17 +1035,48 @@ def format_price(number, is_shipping=False, has_online_stock=False):
         return "0,00€"
     return f"{number:.2f}€".replace(".", ",")
 
-def create_html_report_string(offers, product_title, webcode, discount, branches):
-    best_new_price = None
-    best_display_price = None
-    for offer in offers:
-        if offer['online_stock'] > 0:
-            if offer['on_display']:
-                if best_display_price is None or offer['total_price'] < best_display_price['total_price']:
-                    best_display_price = offer
-            else:
-                if best_new_price is None or offer['total_price'] < best_new_price['total_price']:
-                    best_new_price = offer
+branch_table_cache = ResponseCache(BRANCH_TTL, BRANCH_TTL, 4)
+
+def branch_table_html(branches, version=None):
+    # The "Alle Filialen" table depends only on the branch list, so with a
+    # branch-list version it is built once and reused by every report.
+    key = (version, len(branches))
+    if version is not None:
+        html, _ = branch_table_cache.lookup(key)
+        if html is not None:
+            return html
+    html = ["<h2>Alle Filialen</h2><table><tr><th>Filiale</th><th>Branch ID</th><th>Expert ID</th></tr>"]
+    for b in branches:
+        try:
+            b = as_branch(b)
+        except Exception:
+            continue
+        html.append(f"<tr><td>{b.name} {b.city}</td><td>{b.id}</td><td>{b.exp_id}</td></tr>")
+    html = "\n".join(html) + "\n"
+    if version is not None:
+        branch_table_cache.store(key, html)
+    return html
+
+def offer_row_html(o):
+    if o['online_stock'] == 0:
+        availability = f"Nur lokal verfügbar ({o['stock']}x)"
+    else:
+        availability = f"Online verfügbar ({o['online_stock']}x)"
+        if o['stock']>0:
+            availability += f"<br>Lokal verfügbar ({o['stock']}x)"
+    display_class = " style='background:#fff3cd'" if o['on_display'] else ""
+    return f"<tr{display_class}><td><a href='{o['url']}'>{o['store_name']}</a></td><td>{format_price(o['price'])}</td><td>{format_price(o['shipping'], is_shipping=True, has_online_stock=o['online_stock']>0)}</td><td>{format_price(o['total_price'])}</td><td>{availability}</td></tr>"
+
+def iter_html_report(offers, product_title, webcode, discount, branches, branches_version=None, best_prices=None, chunk_rows=REPORT_CHUNK_ROWS):
+    # Yields the report in chunks of at most chunk_rows offer rows, so it can
+    # be written out without holding the whole document. best_prices
+    # (best new, best display) lets a caller render one page of offers with
+    # the best prices of all of them. branches=None leaves out the table.
+    if best_prices is None:
+        best_prices = (None, None)
+        for offer in offers:
+            best_prices = update_best_prices(best_prices[0], best_prices[1], offer)
+    best_new_price, best_display_price = best_prices
 
     # Build simplified/clean HTML (keeps original layout)
     html = []
@@ -171,35 +1089,35 @@ def create_html_report_string(offers, product_title, webcode, discount, branches
     if best_display_price:
         html.append(f"<p>Ausstellung: {format_price(best_display_price['total_price'])} — <a href='{best_display_price['url']}'>{best_display_price['store_name']}</a></p>")
     html.append("<h2>Angebote</h2><table><tr><th>Filiale</th><th>Preis</th><th>Versand</th><th>Gesamtpreis</th><th>Verfügbarkeit</th></tr>")
+    yield "\n".join(html) + "\n"
+    rows = []
     for o in offers:
-        if o['online_stock'] == 0:
-            availability = f"Nur lokal verfügbar ({o['stock']}x)"
-        else:
-            availability = f"Online verfügbar ({o['online_stock']}x)"
-            if o['stock']>0:
-                availability += f"<br>Lokal verfügbar ({o['stock']}x)"
-        display_class = " style='background:#fff3cd'" if o['on_display'] else ""
-        html.append(f"<tr{display_class}><td><a href='{o['url']}'>{o['store_name']}</a></td><td>{format_price(o['price'])}</td><td>{format_price(o['shipping'], is_shipping=True, has_online_stock=o['online_stock']>0)}</td><td>{format_price(o['total_price'])}</td><td>{availability}</td></tr>")
-    html.append("</table><h2>Alle Filialen</h2><table><tr><th>Filiale</th><th>Branch ID</th><th>Expert ID</th></tr>")
-    for b in branches:
-        try:
-            html.append(f"<tr><td>{b['store']['name']} {b['store']['city']}</td><td>{b['store']['id']}</td><td>{b['store']['expId']}</td></tr>")
-        except Exception:
-            continue
-    html.append("</table></div></body></html>")
-    return "\n".join(html)
+        rows.append(offer_row_html(o))
+        if len(rows) >= chunk_rows:
+            yield "\n".join(rows) + "\n"
+            rows = []
+    if rows:
+        yield "\n".join(rows) + "\n"
+    yield "</table>"
+    if branches is not None:
+        yield branch_table_html(branches, branches_version)
+        yield "</table>"
+    yield "</div></body></html>"
+
+def create_html_report_string(offers, product_title, webcode, discount, branches, branches_version=None, best_prices=None):
+    return "".join(iter_html_report(offers, product_title, webcode, discount, branches, branches_version, best_prices))
 
-def process_branch_offer(branch, url, user_coordinates, only_online_offers, only_new_items, webcode):
+def write_html_report(stream, offers, product_title, webcode, discount, branches, branches_version=None, best_prices=None):
+    # Same report, written chunk by chunk instead of built as one string.
+    for chunk in iter_html_report(offers, product_title, webcode, discount, branches, branches_version, best_prices):
+        stream.write(chunk)
+
+def build_offer(branch, product_data, url, only_online_offers, only_new_items):
     try:
-        branch_id = branch["store"]["id"]
-        expert_id = branch["store"]["expId"]
-        branch_name = branch["store"]["name"]
-        branch_city = branch["store"]["city"]
-        branch_coordinates = (branch["store"]["latitude"], branch["store"]["longitude"])
-        if branch_city not in branch_name:
-            branch_name = f"{branch_name} {branch_city}"
-        final_url = f"{url}?branch_id={branch_id}"
-        product_data = get_branch_product_data(webcode, storeid=expert_id)
+        branch = as_branch(branch)
+        expert_id = branch.exp_id
+        branch_name = branch.display_name
+        final_url = f"{url}?branch_id={branch.id}"
         item_is_used = product_data["price"]["itemOnDisplay"]["onDisplay"] if product_data.get("price", {}).get("itemOnDisplay") else False
 
         if not product_data.get("price", {}).get("bruttoPrice"):
@@ -233,7 +1151,248 @@ def process_branch_offer(branch, url, user_coordinates, only_online_offers, only
             "online_store": product_data["price"].get("onlineStore", False),
             "online_stock": product_data["price"].get("onlineStock", 0),
             "on_display": item_is_used,
-            "coordinates": branch_coordinates,
+            "coordinates": branch.coordinates,
+            "distance": branch.distance,
         }
     except Exception:
         return None
+
+def update_best_prices(best_new_price, best_display_price, offer):
+    if offer and offer['online_stock'] > 0:
+        if offer['on_display']:
+            if best_display_price is None or offer['total_price'] < best_display_price['total_price']:
+                best_display_price = offer
+        else:
+            if best_new_price is None or offer['total_price'] < best_new_price['total_price']:
+                best_new_price = offer
+    return best_new_price, best_display_price
+
+def plan_branch_queries(webcode, branches, use_cache=True):
+    # Splits branches into answers available now (cache hits, and skipped
+    # known misses as None) and the ones to query, likely stockists first.
+    # Skipping is random, so plan once per search and hand the plan on.
+    ready, likely, rechecks = [], [], []
+    skipped = 0
+    for branch in branches:
+        branch = as_branch(branch)
+        hit, data = cached_branch_product_data(webcode, branch.exp_id) if use_cache else (False, None)
+        if hit:
+            ready.append((branch, data))
+        elif not negative_cache.is_miss(webcode, branch.exp_id):
+            likely.append(branch)
+        elif negative_cache.should_skip(webcode, branch.exp_id):
+            ready.append((branch, None))
+            skipped += 1
+        else:
+            rechecks.append(branch)
+    if skipped:
+        metrics.inc("expert_negative_cache_skips_total", skipped)
+    return ready, likely + rechecks
+
+def iter_offers(branches, url, only_online_offers, only_new_items, webcode, plan=None, use_cache=True):
+    # Yields one update per finished branch (cache hits first), with the offer
+    # (or None) and the running best new/display prices. plan is the result
+    # of plan_branch_queries for these branches, e.g. from prefetch_offers.
+    # use_cache=False keeps the answers out of price_cache.
+    total = len(branches)
+    completed = 0
+    best_new_price = best_display_price = None
+    ready, to_fetch = plan if plan is not None else plan_branch_queries(webcode, branches, use_cache)
+    pending = collections.defaultdict(list)
+    for branch in to_fetch:
+        key = (str(webcode), str(branch.exp_id))
+        pending[scheduler.submit(key, get_branch_product_data, webcode, branch.exp_id, use_cache=use_cache)].append(branch)
+
+    def results():
+        yield from ready
+        for f in concurrent.futures.as_completed(pending):
+            try:
+                data = f.result()
+            except Exception:
+                data = None
+            for branch in pending[f]:
+                yield branch, data
+
+    for branch, data in results():
+        completed += 1
+        offer = build_offer(branch, data, url, only_online_offers, only_new_items) if data else None
+        best_new_price, best_display_price = update_best_prices(best_new_price, best_display_price, offer)
+        yield {
+            "offer": offer,
+            "completed": completed,
+            "total": total,
+            "best_new": best_new_price,
+            "best_display": best_display_price,
+        }
+    negative_cache.save()
+
+def filter_offers(offers, only_online_offers=False, only_new_items=False, max_distance=None):
+    # Same filters as build_offer, applied to already fetched offers.
+    return [
+        o for o in offers
+        if not (only_online_offers and not o['online_stock'])
+        and not (only_new_items and o['on_display'])
+        and not (max_distance and o['distance'] is not None and o['distance'] > max_distance)
+    ]
+
+def fetch_offers(branches, url, only_online_offers, only_new_items, webcode, on_progress=None):
+    offers = []
+    for update in iter_offers(branches, url, only_online_offers, only_new_items, webcode):
+        if update["offer"]:
+            offers.append(update["offer"])
+        if on_progress:
+            on_progress(update["completed"], update["total"])
+    return offers
+
+def webcode_from_url(url):
+    return url.split("/")[-1].split("-")[0]
+
+def article_title(info, default):
+    if not info:
+        return default
+    if info.get("seoPageTitle"):
+        return info["seoPageTitle"].split(" - bei expert kaufen")[0]
+    return info.get("article", default)
+
+class Product:
+    __slots__ = ("articleId", "webcode", "url", "title")
+
+    def __init__(self, articleId, webcode, url, title=None):
+        self.articleId = articleId
+        self.webcode = webcode
+        self.url = url
+        self.title = title or webcode
+
+    @classmethod
+    def from_suggestion(cls, suggestion):
+        articleId, url, title = suggestion
+        return cls(articleId, webcode_from_url(url), url, title)
+
+# Resolved products per input; product data changes rarely, so one hour.
+product_cache = ResponseCache(ttl=3600, stale_ttl=3600, max_size=2000)
+
+def is_product_reference(term):
+    term = term.strip()
+    if "www.expert.de" in term and ".html" in term:
+        return True
+    return term.rpartition(":")[2].strip().isdigit()
+
+def resolve_product(term, timeout=8):
+    # URL, "webcode:<n>", "article:<n>" or a bare articleId -> Product, each
+    # upstream lookup done once. Free-text terms return None (use the
+    # suggest API via get_article_id_from_search).
+    if isinstance(term, Product):
+        return term
+    term = term.strip()
+    key = (term,)
+    product, state = product_cache.lookup(key)
+    if state is not None:
+        return product
+    product, complete = _resolve_product(term, timeout)
+    # A product missing its articleId or title after an upstream error is
+    # returned but not cached, so the next search tries again.
+    if complete:
+        product_cache.store(key, product)
+    return product
+
+def _lookup_article(webcode, timeout):
+    # articleId (pricepds) and title (search/article) are independent;
+    # either is None if its lookup failed.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        articleId = pool.submit(get_article_id_for_webcode, webcode, timeout)
+        info = pool.submit(get_article_info, webcode, timeout)
+    try:
+        articleId = articleId.result()
+    except Exception:
+        articleId = None
+    try:
+        info = info.result()
+    except Exception:
+        info = None
+    return articleId, info
+
+def _resolve_product(term, timeout):
+    # Returns (product or None, whether every lookup succeeded).
+    if "www.expert.de" in term and ".html" in term:
+        url = term.split(".html")[0] + ".html"
+        webcode = webcode_from_url(url)
+        articleId, info = _lookup_article(webcode, timeout)
+        return Product(articleId, webcode, url, article_title(info, webcode)), bool(articleId and info)
+    kind, _, value = term.rpartition(":")
+    value = value.strip()
+    if not value.isdigit():
+        return None, False
+    if kind.strip().lower() == "webcode":
+        webcode = value
+        articleId, info = _lookup_article(webcode, timeout)
+    else:
+        try:
+            webcode, articleId = get_webcode(value, timeout), int(value)
+            info = get_article_info(webcode, timeout) if webcode else None
+        except Exception:
+            return None, False
+    if not info or not info.get("link"):
+        return None, False
+    return Product(articleId, webcode, f"https://www.expert.de{info['link']}", article_title(info, webcode)), bool(articleId)
+
+def prefetch_offers(webcode, branches):
+    # Queues the pricepds queries now and returns the plan; iter_offers
+    # given that plan joins the same in-flight futures through the scheduler
+    # or finds the cached data.
+    plan = plan_branch_queries(webcode, branches)
+    for branch in plan[1]:
+        scheduler.submit((str(webcode), str(branch.exp_id)), get_branch_product_data, webcode, branch.exp_id)
+    return plan
+
+def _completed(value):
+    future = concurrent.futures.Future()
+    future.set_result(value)
+    return future
+
+class PreparedSearch:
+    # Runs product resolution, geocoding and branch loading concurrently, then
+    # the discount lookup and the fan-out prefetch as soon as their inputs are
+    # ready. Each search gets its own small pool, so chained waits can never
+    # starve other sessions.
+    def __init__(self, term, plz=None, max_distance=None, trace=None):
+        self.max_distance = max_distance
+        self.trace = trace
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=5, thread_name_prefix="expert-prepare")
+        self.product = self._pool.submit(self._stage, "resolve", resolve_product, term)
+        self.coordinates = self._pool.submit(self._stage, "geocoding", get_coordinates, plz) if plz else _completed(None)
+        self.branch_set = self._pool.submit(self._stage, "branches", branch_registry.get)
+        self.discount = self._pool.submit(self._discount)
+        self.branches = self._pool.submit(self._plan_branches)
+        self._pool.shutdown(wait=False)
+
+    def _stage(self, name, fn, *args):
+        if self.trace is None:
+            return fn(*args)
+        with self.trace.stage(name):
+            return fn(*args)
+
+    def _discount(self):
+        product = self.product.result()
+        if not product or not product.articleId:
+            return 0
+        try:
+            return self._stage("discount", get_discount, product.articleId)
+        except Exception:
+            return 0
+
+    def _plan_branches(self):
+        # Returns (all branches incl. online shop, branches to query, query
+        # plan for iter_offers or None without a product).
+        branch_set = self.branch_set.result()
+        coordinates = self.coordinates.result()
+        if coordinates:
+            # Uses the branch set's precomputed coordinate array.
+            branches = attach_distances(branch_set, coordinates) + [ONLINE_SHOP]
+        else:
+            branches = list(branch_set.branches) + [ONLINE_SHOP]
+        query_branches = branches
+        if coordinates and self.max_distance:
+            query_branches = branches_in_range(branches, coordinates, self.max_distance, index=branch_set.index)
+        product = self.product.result()
+        plan = prefetch_offers(product.webcode, query_branches) if product else None
+        return branches, query_branches, plan
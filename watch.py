@@ -0,0 +1,215 @@
+# watch.py
+# Watchlist monitor: polls pricepds per (webcode, store) on a schedule and
+# emits only what changed (price, onlineStock, storeStock, itemOnDisplay).
+#
+#   python watch.py watchlist.txt --state watch_state.json -o changes.jsonl
+#   python watch.py watchlist.txt --plz 10115 --max-distance 50 --once
+#
+# The watchlist uses the batch.py input format. Stores whose state changed
+# recently are polled every --min-interval; every unchanged poll doubles a
+# store's interval up to --max-interval. Requests carry If-None-Match /
+# If-Modified-Since when pricepds sent validators, so unchanged data can come
+# back as an empty 304.
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import expert_checker_core as core
+from batch import read_inputs
+
+WATCHED_FIELDS = ("listed", "price", "onlineStock", "storeStock", "itemOnDisplay")
+
+def product_state(product_data):
+    price_info = (product_data or {}).get("price") or {}
+    if not price_info.get("bruttoPrice"):
+        return {"listed": False}
+    promotion_info = product_data.get("promotionPrice", {})
+    display = price_info.get("itemOnDisplay")
+    return {
+        "listed": True,
+        "price": round(float(promotion_info.get("checkoutPrice", price_info["bruttoPrice"])), 2),
+        "onlineStock": price_info.get("onlineStock", 0),
+        "storeStock": price_info.get("storeStock", 0),
+        "itemOnDisplay": bool(display and display.get("onDisplay")),
+    }
+
+def diff_states(old, new):
+    return {f: [old.get(f), new.get(f)] for f in WATCHED_FIELDS if old.get(f) != new.get(f)}
+
+class Watchlist:
+    def __init__(self, state_path, min_interval, max_interval):
+        self.state_path = state_path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        if state_path and os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(webcode, store):
+        return f"{webcode}|{store}"
+
+    def track(self, webcode, branch, url):
+        key = self.key(webcode, branch.exp_id)
+        with self._lock:
+            entry = self.entries.setdefault(key, {"next_poll": 0, "interval": self.min_interval})
+            entry.update({"webcode": webcode, "store": branch.exp_id, "store_name": branch.display_name, "url": f"{url}?branch_id={branch.id}"})
+
+    def prune(self, keep):
+        with self._lock:
+            for key in set(self.entries) - set(keep):
+                del self.entries[key]
+                self._dirty = True
+
+    def due(self, now):
+        with self._lock:
+            return [k for k, e in self.entries.items() if e["next_poll"] <= now and not e.get("polling")]
+
+    def mark_polling(self, key):
+        with self._lock:
+            self.entries[key]["polling"] = True
+
+    def apply(self, key, result, now):
+        # Returns the delta record to emit, or None.
+        with self._lock:
+            entry = self.entries[key]
+            entry.pop("polling", None)
+            self._dirty = True
+            if result is None:
+                # Rate limited or failed: retry at the current interval.
+                entry["next_poll"] = now + entry["interval"]
+                return None
+            entry["etag"] = result["etag"]
+            entry["last_modified"] = result["last_modified"]
+            changes = {}
+            if not result["not_modified"]:
+                new_state = product_state(result["data"])
+                old_state = entry.get("state")
+                entry["state"] = new_state
+                if old_state is not None:
+                    changes = diff_states(old_state, new_state)
+            if changes:
+                entry["interval"] = self.min_interval
+                entry["last_change"] = now
+            else:
+                entry["interval"] = min(self.max_interval, entry["interval"] * 2)
+            # Small jitter so stores do not fall into lockstep.
+            entry["next_poll"] = now + entry["interval"] * random.uniform(0.9, 1.1)
+            if not changes:
+                return None
+            return {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now)),
+                "webcode": entry["webcode"],
+                "store": entry["store"],
+                "store_name": entry["store_name"],
+                "url": entry["url"],
+                "changes": changes,
+                "state": entry["state"],
+            }
+
+    def save(self, force=False):
+        with self._lock:
+            if not self.state_path or not (self._dirty or force):
+                return
+            snapshot = {k: {f: v for f, v in e.items() if f != "polling"} for k, e in self.entries.items()}
+            self._dirty = False
+        tmp = self.state_path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, self.state_path)
+
+def poll(entry):
+    result = core.poll_branch_product_data(entry["webcode"], entry["store"], entry.get("etag"), entry.get("last_modified"))
+    if result and result["data"] is not None:
+        # Fresh data is also useful to interactive searches in this process.
+        core.price_cache.store((str(entry["webcode"]), str(entry["store"])), result["data"])
+    return result
+
+def run(watchlist, out, once=False, save_every=30):
+    last_save = time.time()
+    pending = {}
+    while True:
+        now = time.time()
+        for key in watchlist.due(now):
+            watchlist.mark_polling(key)
+            # Runs on the shared pool and rate budget; the key keeps one
+            # entry from being polled twice at once.
+            entry = watchlist.entries[key]
+            pending[core.scheduler.submit(("watch", key), poll, dict(entry))] = key
+        for future in [f for f in pending if f.done()]:
+            key = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                if core.DEBUG:
+                    print(f"Fehler bei {key}: {e}", file=sys.stderr)
+                result = None
+            delta = watchlist.apply(key, result, time.time())
+            if delta:
+                out.write(json.dumps(delta, ensure_ascii=False) + "\n")
+                out.flush()
+        if time.time() - last_save >= save_every:
+            watchlist.save()
+            last_save = time.time()
+        if once and not pending:
+            watchlist.save()
+            return
+        time.sleep(0.2)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="expert checker Watchlist-Monitor")
+    parser.add_argument("watchlist", help="Datei mit URLs, Webcodes oder Artikelnummern (eine pro Zeile)")
+    parser.add_argument("--state", default="watch_state.json", help="Zustandsdatei (letzter bekannter Stand)")
+    parser.add_argument("-o", "--output", default="-", help="Änderungen als JSONL, Standard: stdout")
+    parser.add_argument("--plz", help="nur Filialen im Umkreis dieser PLZ (plus Onlineshop)")
+    parser.add_argument("--max-distance", type=int, default=0, help="Umkreis in km (mit --plz)")
+    parser.add_argument("--min-interval", type=float, default=300, help="Sekunden für kürzlich geänderte Filialen")
+    parser.add_argument("--max-interval", type=float, default=6 * 3600, help="Sekunden für unveränderte Filialen")
+    parser.add_argument("--once", action="store_true", help="nur einen Durchlauf der fälligen Abfragen")
+    args = parser.parse_args(argv)
+
+    branch_set = core.branch_registry.get()
+    branches = list(branch_set.branches) + [core.ONLINE_SHOP]
+    if args.plz:
+        user_coords = core.get_coordinates(args.plz)
+        if user_coords is None:
+            print(f"PLZ {args.plz} nicht gefunden.", file=sys.stderr)
+            return 2
+        if args.max_distance:
+            branches = core.branches_in_range(branches, user_coords, args.max_distance, index=branch_set.index)
+
+    watchlist = Watchlist(args.state, args.min_interval, args.max_interval)
+    tracked = []
+    for line in read_inputs(args.watchlist):
+        product = core.resolve_product(line)
+        if product is None:
+            print(f"Übersprungen (nicht auflösbar): {line}", file=sys.stderr)
+            continue
+        webcode, url = product.webcode, product.url
+        for branch in branches:
+            watchlist.track(webcode, branch, url)
+            tracked.append(Watchlist.key(webcode, branch.exp_id))
+    watchlist.prune(tracked)
+    print(f"{len(watchlist.entries)} (Webcode, Filiale)-Paare beobachtet.", file=sys.stderr)
+
+    out = sys.stdout if args.output == "-" else open(args.output, 'a', encoding='utf-8')
+    try:
+        run(watchlist, out, once=args.once)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watchlist.save(force=True)
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())